@@ -1,2 +1,4 @@
 JSON_TRUE='true'
-JSON_FALSE='false'
\ No newline at end of file
+JSON_FALSE='false'
+JSON_PATCH_SET = 'SET'
+JSON_PATCH_REMOVE = 'REMOVE'
@@ -1,12 +1,15 @@
 import json
 
 
+from . import profiling, tracking
+from .constants import JSON_PATCH_SET
 from .encoders import JSONEncoder
 from django.core import exceptions
-from django.db.models import TextField, FloatField, Transform, lookups as builtin_lookups
+from django.db.models import CharField, Expression, F, TextField, FloatField, Transform, lookups as builtin_lookups
+from django.db import transaction
+from django.db.models import signals
 from django.utils.translation import gettext_lazy as _
 from django.db.backends.oracle.base import DatabaseWrapper
-from django.db.models import lookups
 
 __all__ = ['JSONField']
 
@@ -20,13 +23,27 @@ class JSONField(TextField):
         'invalid': _("Value must be valid JSON."),
     }
     _default_hint = ('dict', '{}')
+    # Above this share of the loaded document size, tracked changes are saved as a full rewrite
+    patch_size_ratio = 0.5
 
-    def __init__(self, verbose_name=None, name=None, encoder=None, **kwargs):
+    def __init__(self, verbose_name=None, name=None, encoder=None, track_changes=False, **kwargs):
         if encoder and not callable(encoder):
             raise ValueError("The encoder parameter must be a callable object.")
         self.encoder = encoder or JSONEncoder
+        self.track_changes = track_changes
         super().__init__(verbose_name, name, **kwargs)
 
+    def _clean_tracked_value(self, sender, instance, update_fields=None, using=None, **kwargs):
+        if update_fields is not None and self.name not in update_fields:
+            return
+        value = instance.__dict__.get(self.attname)
+        if not tracking.is_tracked_root(value) or not tracking.is_owned_by(value, instance):
+            return
+        saved = tracking.finish_save(value)
+        if saved is not None:
+            # A rolled back save keeps its changes pending for the next save
+            transaction.on_commit(lambda: tracking.mark_clean(value, saved), using=using)
+
     def db_type(self, connection):
         return 'clob'
 
@@ -46,6 +63,8 @@ class JSONField(TextField):
         name, path, args, kwargs = super().deconstruct()
         if self.encoder is not None:
             kwargs['encoder'] = self.encoder
+        if self.track_changes:
+            kwargs['track_changes'] = True
         return name, path, args, kwargs
 
     def get_transform(self, name):
@@ -57,7 +76,13 @@ class JSONField(TextField):
     def from_db_value(self, value, expression, connection):
         if value is None:
             return value
-        return json.loads(str(value))
+        value = str(value)
+        if not self.track_changes:
+            return json.loads(value)
+        document = tracking.track(json.loads(value))
+        if tracking.is_tracked_root(document):
+            tracking.mark_loaded(document, len(value))
+        return document
 
     def to_python(self, value):
         if isinstance(value, dict):
@@ -68,6 +93,18 @@ class JSONField(TextField):
         if value is None:
             return value
 
+    def pre_save(self, model_instance, add):
+        value = super().pre_save(model_instance, add)
+        if not tracking.is_tracked_root(value) or not tracking.is_owned_by(value, model_instance):
+            return value
+        tracking.start_save(value)
+        if add:
+            return value
+        operations = tracking.get_patch_operations(value, self.encoder, self.patch_size_ratio)
+        if operations is None or not all(JSONTransform.can_express(path) for _, path, _ in operations):
+            return value
+        return JSONTransform(F(self.attname), operations, output_field=self)
+
     def get_prep_value(self, value):
         if value is not None:
             return json.dumps(value, cls=self.encoder)
@@ -92,6 +129,112 @@ class JSONField(TextField):
         return super().formfield(**{**kwargs})
 
 
+def _tracked_fields(model):
+    return [field for field in model._meta.concrete_fields if isinstance(field, JSONField) and field.track_changes]
+
+
+def _claim_tracked_values_on_load(model):
+    """
+    Wrap model.from_db() and refresh_from_db() so tracked documents are owned by the
+    instance loaded with them.
+
+    Only the owner may save a document as a patch, documents reaching an instance any
+    other way (values(), assignment, another instance) are always rewritten in full.
+    """
+    from_db = model.from_db.__func__
+    if not getattr(from_db, 'claims_tracked_json', False):
+        def claiming_from_db(cls, db, field_names, values):
+            instance = from_db(cls, db, field_names, values)
+            for field in _tracked_fields(cls):
+                value = instance.__dict__.get(field.attname)
+                if tracking.is_tracked_root(value):
+                    tracking.claim(value, instance)
+            return instance
+
+        claiming_from_db.claims_tracked_json = True
+        model.from_db = classmethod(claiming_from_db)
+
+    refresh_from_db = model.refresh_from_db
+    if not getattr(refresh_from_db, 'claims_tracked_json', False):
+        def claiming_refresh_from_db(self, *args, **kwargs):
+            fields = _tracked_fields(type(self))
+            before = [self.__dict__.get(field.attname) for field in fields]
+            refresh_from_db(self, *args, **kwargs)
+            for field, old in zip(fields, before):
+                # Loaded by a temporary instance, this also covers reading a deferred field
+                value = self.__dict__.get(field.attname)
+                if value is not old and tracking.is_tracked_root(value):
+                    tracking.reclaim(value, self)
+
+        claiming_refresh_from_db.claims_tracked_json = True
+        model.refresh_from_db = claiming_refresh_from_db
+
+
+def _prepare_tracked_model(sender, **kwargs):
+    fields = _tracked_fields(sender)
+    if not fields:
+        return
+    _claim_tracked_values_on_load(sender)
+    # Connected per model, class_prepared also covers proxy and multi-table inheritance children
+    for field in fields:
+        signals.post_save.connect(field._clean_tracked_value, sender=sender)
+
+
+signals.class_prepared.connect(_prepare_tracked_model)
+
+
+def json_path(keys):
+    """Oracle JSON path for a sequence of object keys and array indices."""
+    return '$' + ''.join('[%d]' % key if isinstance(key, int) else '."%s"' % key for key in keys)
+
+
+def json_value_sql(column_sql, keys, returning=None):
+    """
+    JSON_VALUE() of a key path. Key lookups and the indexes json_path_advisor suggests are
+    both built here, Oracle only uses a function-based index for an identical expression.
+    """
+    sql = "JSON_VALUE(%s, '%s'" % (column_sql, json_path(keys).replace("'", "''"))
+    if returning:
+        sql += ' RETURNING %s' % returning
+    return sql + ')'
+
+
+class JSONTransform(Expression):
+    """
+    Applies tracked changes to a stored document in place, e.g.
+        JSON_TRANSFORM("JSON", SET '$."a"."b"' = %s FORMAT JSON, REMOVE '$."c"' IGNORE ON MISSING RETURNING CLOB)
+    """
+
+    def __init__(self, column, operations, output_field=None):
+        super().__init__(output_field=output_field)
+        self.column = column
+        self.operations = tuple(operations)
+
+    @staticmethod
+    def can_express(path):
+        return all(isinstance(key, int) or not any(c in key for c in '"\\\'%') for key in path)
+
+    def get_source_expressions(self):
+        return [self.column]
+
+    def set_source_expressions(self, exprs):
+        self.column, = exprs
+
+    def as_sql(self, compiler, connection):
+        column_sql, params = compiler.compile(self.column)
+        params = list(params)
+        if not self.operations:
+            return column_sql, params
+        clauses = []
+        for operation, path, value in self.operations:
+            if operation == JSON_PATCH_SET:
+                clauses.append("SET '%s' = %%s FORMAT JSON" % json_path(path))
+                params.append(value)
+            else:
+                clauses.append("REMOVE '%s' IGNORE ON MISSING" % json_path(path))
+        return 'JSON_TRANSFORM(%s, %s RETURNING CLOB)' % (column_sql, ', '.join(clauses)), params
+
+
 class KeyTransform(Transform):
     operator = '.'
     nested_operator = '.'
@@ -100,12 +243,17 @@ class KeyTransform(Transform):
         super().__init__(*args, **kwargs)
         self.key_name = key_name
 
-    def as_sql(self, compiler, connection):
+    def key_chain(self):
+        """Return the keys of this (nested) transform and the expression they apply to."""
         key_transforms = [self.key_name]
         previous = self.lhs
         while isinstance(previous, KeyTransform):
             key_transforms.insert(0, previous.key_name)
             previous = previous.lhs
+        return key_transforms, previous
+
+    def as_sql(self, compiler, connection):
+        key_transforms, previous = self.key_chain()
         lhs, params = compiler.compile(previous)
         if len(key_transforms) > 1:
             quoted_keys = map(lambda x: '"{0}"'.format(x), key_transforms)
@@ -126,15 +274,44 @@ class KeyTextTransform(KeyTransform):
     output_field = TextField()
 
 
+class KeyValueTransform(KeyTransform):
+    """
+    Scalar at a key path, as JSON_VALUE() rather than dot notation so lookups can use an index.
+    Unlike dot notation this is NULL for objects and arrays, so only the lookups an index
+    can serve use it.
+    """
+    returning = None
 
+    def as_sql(self, compiler, connection):
+        key_transforms, previous = self.key_chain()
+        lhs, params = compiler.compile(previous)
+        keys = [key.replace('%', '%%') for key in key_transforms]
+        return json_value_sql(lhs, keys, self.returning), params
 
-class KeyFloatTransform(KeyTransform):
-    operator = '.'
-    nested_operator = '.'
+
+class KeyValueTextTransform(KeyValueTransform):
+    # Not a TextField, the Oracle backend would compare NCLOBs through DBMS_LOB.SUBSTR()
+    output_field = CharField()
+
+
+class KeyFloatTransform(KeyValueTransform):
+    returning = 'NUMBER'
     output_field = FloatField()
 
 
-class KeyTransformTextLookupMixin:
+class PathUsageLookupMixin:
+    """Records the JSON path and lookup type when ORACLE_JSON_PATH_PROFILE is set."""
+
+    def as_sql(self, compiler, connection):
+        if profiling.is_enabled():
+            keys, base = self.lhs.key_chain() if isinstance(self.lhs, KeyTransform) else ([], self.lhs)
+            field = getattr(base, 'target', None)
+            if isinstance(field, JSONField):
+                profiling.record(field, keys, self.lookup_name)
+        return super().as_sql(compiler, connection)
+
+
+class KeyTransformTextLookupMixin(PathUsageLookupMixin):
     def __init__(self, key_transform, *args, **kwargs):
         assert isinstance(key_transform, KeyTransform)
         key_text_transform = KeyTextTransform(
@@ -143,7 +320,16 @@ class KeyTransformTextLookupMixin:
         super().__init__(key_text_transform, *args, **kwargs)
 
 
-class KeyTransformFloatLookupMixin:
+class KeyTransformValueLookupMixin(PathUsageLookupMixin):
+    def __init__(self, key_transform, *args, **kwargs):
+        assert isinstance(key_transform, KeyTransform)
+        key_text_transform = KeyValueTextTransform(
+            key_transform.key_name, *key_transform.source_expressions, **key_transform.extra
+        )
+        super().__init__(key_text_transform, *args, **kwargs)
+
+
+class KeyTransformFloatLookupMixin(PathUsageLookupMixin):
     def __init__(self, key_transform, *args, **kwargs):
         assert isinstance(key_transform, KeyTransform)
         key_text_transform = KeyFloatTransform(
@@ -152,7 +338,7 @@ class KeyTransformFloatLookupMixin:
         super().__init__(key_text_transform, *args, **kwargs)
 
 
-class KeyTransformIn(KeyTransformTextLookupMixin, builtin_lookups.In):
+class KeyTransformIn(KeyTransformValueLookupMixin, builtin_lookups.In):
     pass
 
 
@@ -160,7 +346,7 @@ class KeyTransformIExact(KeyTransformTextLookupMixin, builtin_lookups.IExact):
     pass
 
 
-class KeyTransformExact(KeyTransformTextLookupMixin, builtin_lookups.Exact):
+class KeyTransformExact(KeyTransformValueLookupMixin, builtin_lookups.Exact):
     pass
 
 
@@ -168,7 +354,7 @@ class KeyTransformIContains(KeyTransformTextLookupMixin, builtin_lookups.IContai
     pass
 
 
-class KeyTransformStartsWith(KeyTransformTextLookupMixin, builtin_lookups.StartsWith):
+class KeyTransformStartsWith(KeyTransformValueLookupMixin, builtin_lookups.StartsWith):
     pass
 
 
@@ -208,6 +394,30 @@ class KeyTransformLessThanOrEqual(KeyTransformFloatLookupMixin, builtin_lookups.
     pass
 
 
+class JSONFieldGreaterThan(PathUsageLookupMixin, builtin_lookups.GreaterThan):
+    pass
+
+
+class JSONFieldGreaterThanOrEqual(PathUsageLookupMixin, builtin_lookups.GreaterThanOrEqual):
+    pass
+
+
+class JSONFieldLessThan(PathUsageLookupMixin, builtin_lookups.LessThan):
+    pass
+
+
+class JSONFieldLessThanOrEqual(PathUsageLookupMixin, builtin_lookups.LessThanOrEqual):
+    pass
+
+
+class JSONFieldContains(PathUsageLookupMixin, builtin_lookups.Contains):
+    pass
+
+
+class JSONFieldIn(PathUsageLookupMixin, builtin_lookups.In):
+    pass
+
+
 class KeyTransformFactory:
 
     def __init__(self, key_name):
@@ -219,12 +429,12 @@ class KeyTransformFactory:
 
 def initialise_field():
 
-    JSONField.register_lookup(lookups.GreaterThan)
-    JSONField.register_lookup(lookups.GreaterThanOrEqual)
-    JSONField.register_lookup(lookups.LessThan)
-    JSONField.register_lookup(lookups.LessThanOrEqual)
-    JSONField.register_lookup(lookups.Contains)
-    JSONField.register_lookup(lookups.In)
+    JSONField.register_lookup(JSONFieldGreaterThan)
+    JSONField.register_lookup(JSONFieldGreaterThanOrEqual)
+    JSONField.register_lookup(JSONFieldLessThan)
+    JSONField.register_lookup(JSONFieldLessThanOrEqual)
+    JSONField.register_lookup(JSONFieldContains)
+    JSONField.register_lookup(JSONFieldIn)
 
     KeyTransform.register_lookup(KeyTransformIn)
     KeyTransform.register_lookup(KeyTransformExact)
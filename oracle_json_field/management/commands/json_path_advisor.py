@@ -0,0 +1,123 @@
+import re
+from collections import Counter
+
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.backends.utils import truncate_name
+
+from oracle_json_field import profiling
+from oracle_json_field.fields import KeyFloatTransform, json_path, json_value_sql
+
+# Key lookups compiled to JSON_VALUE(), see KeyTransformValueLookupMixin
+INDEXABLE_LOOKUPS = {'exact', 'in', 'startswith'}
+NUMERIC_LOOKUPS = {'gt', 'gte', 'lt', 'lte'}
+# Below this share of distinct values among the sampled documents an index rarely pays off
+LOW_SELECTIVITY = 0.01
+
+
+class Command(BaseCommand):
+    help = 'Reports the most filtered JSON paths, their sampled selectivity and suggested index DDL.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--profile', default=None,
+            help='Path usage file, defaults to the ORACLE_JSON_PATH_PROFILE setting.',
+        )
+        parser.add_argument('--top', type=int, default=20, help='Number of paths to report.')
+        parser.add_argument(
+            '--sample-percent', type=float, default=10,
+            help='Percentage of rows sampled per path with SAMPLE (n), 100 reads the whole table.',
+        )
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help='Database to sample documents from.')
+
+    def handle(self, *args, **options):
+        path = options['profile'] or getattr(settings, 'ORACLE_JSON_PATH_PROFILE', None)
+        if not path:
+            raise CommandError('No path usage file, set ORACLE_JSON_PATH_PROFILE or pass --profile.')
+        if not 0 < options['sample_percent'] <= 100:
+            raise CommandError('--sample-percent must be above 0 and at most 100.')
+        profiling.flush()
+        try:
+            usage = profiling.load(path)
+        except OSError as e:
+            raise CommandError('Cannot read path usage file: %s' % e)
+
+        paths = {}
+        for (model, field, keys, lookup), count in usage.items():
+            paths.setdefault((model, field, keys), Counter())[lookup] += count
+        if not paths:
+            self.stdout.write('No JSON path usage recorded yet.')
+            return
+
+        connection = connections[options['database']]
+        ranked = sorted(paths.items(), key=lambda item: sum(item[1].values()), reverse=True)
+        for (label, field_name, keys), lookups in ranked[:options['top']]:
+            self.stdout.write('%s.%s %s' % (label, field_name, json_path(keys)))
+            self.stdout.write('  queries: %d (%s)' % (
+                sum(lookups.values()), ', '.join('%s=%d' % item for item in lookups.most_common())
+            ))
+            try:
+                model = apps.get_model(label)
+                field = model._meta.get_field(field_name)
+            except (LookupError, FieldDoesNotExist):
+                self.stdout.write('  model or field no longer exists, skipped')
+                self.stdout.write('')
+                continue
+
+            if keys:
+                sampled, present, distinct = self.sample(connection, model, field, keys, options['sample_percent'])
+                selectivity = distinct / present if present else 0.0
+                self.stdout.write('  sampled: %d documents (%g%%), %d with a value, %d distinct values (selectivity %.3f)' % (
+                    sampled, options['sample_percent'], present, distinct, selectivity
+                ))
+                if present and selectivity < LOW_SELECTIVITY:
+                    self.stdout.write('  -- low selectivity, an index is unlikely to help')
+            for statement in self.recommend(connection, model, field, keys, lookups):
+                self.stdout.write('  %s' % statement)
+            self.stdout.write('')
+
+    @staticmethod
+    def sample(connection, model, field, keys, percent):
+        """Count sampled rows, rows with a scalar at the path and its distinct values, in the database."""
+        value = json_value_sql(connection.ops.quote_name(field.column), [key.replace('%', '%%') for key in keys])
+        # SAMPLE picks random rows across the table and takes no bind variables, 100 is not allowed.
+        # Empty params still run the %% escaped keys through the backend's placeholder formatting.
+        sample = ' SAMPLE (%r)' % float(percent) if percent < 100 else ''
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*), COUNT(v), COUNT(DISTINCT v) FROM (SELECT %s v FROM %s%s)' % (
+                value, connection.ops.quote_name(model._meta.db_table), sample
+            ), [])
+            return cursor.fetchone()
+
+    def recommend(self, connection, model, field, keys, lookups):
+        if not keys:
+            return ['-- whole document lookups, no path to index']
+        if any('"' in key for key in keys):
+            return ['-- path cannot be expressed in DDL']
+        table = connection.ops.quote_name(model._meta.db_table)
+        column = connection.ops.quote_name(field.column)
+        max_length = connection.ops.max_name_length()
+        suffix = re.sub(r'\W', '_', '_'.join(keys))
+
+        statements = []
+        # The same JSON_VALUE() expressions KeyValueTextTransform and KeyFloatTransform compile to
+        if INDEXABLE_LOOKUPS.intersection(lookups):
+            index = truncate_name('%s_%s_IDX' % (model._meta.db_table, suffix), max_length)
+            statements.append('CREATE INDEX %s ON %s (%s);' % (
+                connection.ops.quote_name(index), table, json_value_sql(column, keys)
+            ))
+        if NUMERIC_LOOKUPS.intersection(lookups):
+            index = truncate_name('%s_%s_NUM_IDX' % (model._meta.db_table, suffix), max_length)
+            statements.append('CREATE INDEX %s ON %s (%s);' % (
+                connection.ops.quote_name(index), table, json_value_sql(column, keys, KeyFloatTransform.returning)
+            ))
+        if not statements:
+            index = truncate_name('%s_%s_SEARCH_IDX' % (model._meta.db_table, field.column), max_length)
+            statements.append('-- no B-tree friendly lookups, consider a JSON search index')
+            statements.append('CREATE SEARCH INDEX %s ON %s (%s) FOR JSON;' % (
+                connection.ops.quote_name(index), table, column
+            ))
+        return statements
@@ -0,0 +1,113 @@
+import atexit
+import json
+import logging
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+
+__all__ = ['is_enabled', 'record', 'flush', 'load']
+
+# Set ORACLE_JSON_PATH_PROFILE to a file path to record which JSON paths are filtered on.
+# Each process appends its counts to that file every ORACLE_JSON_PATH_PROFILE_INTERVAL seconds.
+DEFAULT_FLUSH_INTERVAL = 60
+
+logger = logging.getLogger(__name__)
+
+
+def is_enabled():
+    return bool(getattr(settings, 'ORACLE_JSON_PATH_PROFILE', None))
+
+
+class PathUsageCounter:
+    """
+    Counts (model, field, key path, lookup) usages without taking a lock per call.
+
+    Every thread increments its own dict, held in a one item list so a flush can swap in
+    an empty dict instead of editing one that is being counted into. The shared lock is
+    only taken when a thread is first seen and on flush. An increment racing a flush from
+    another thread may be lost, so counts are approximate.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._buffers = []
+        self._lock = threading.Lock()
+        self._flushed_at = time.monotonic()
+        self._write_failed = False
+        atexit.register(self.flush)
+
+    def _buffer(self):
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None:
+            buffer = self._local.buffer = [{}]
+            with self._lock:
+                self._buffers.append((threading.current_thread(), buffer))
+        return buffer
+
+    def record(self, key):
+        counts = self._buffer()[0]
+        counts[key] = counts.get(key, 0) + 1
+        interval = getattr(settings, 'ORACLE_JSON_PATH_PROFILE_INTERVAL', DEFAULT_FLUSH_INTERVAL)
+        if time.monotonic() - self._flushed_at >= interval:
+            self.flush(interval)
+
+    def flush(self, interval=0):
+        with self._lock:
+            # Checked again under the lock so only one of the threads due to flush does
+            if time.monotonic() - self._flushed_at < interval:
+                return
+            self._flushed_at = time.monotonic()
+            drained = []
+            for thread, buffer in self._buffers:
+                counts, buffer[0] = buffer[0], {}
+                drained.append(counts)
+            # Buffers of finished threads are dropped once drained
+            self._buffers = [(thread, buffer) for thread, buffer in self._buffers if thread.is_alive()]
+        totals = Counter()
+        for counts in drained:
+            # Copied first, the owning thread may still be finishing an increment
+            totals.update(dict(counts))
+        self._write(totals)
+
+    def _write(self, counts):
+        if not counts:
+            return
+        path = getattr(settings, 'ORACLE_JSON_PATH_PROFILE', None)
+        if not path:
+            return
+        rows = [[model, field, list(keys), lookup, count] for (model, field, keys, lookup), count in counts.items()]
+        # A single appended line per flush keeps concurrent processes from interleaving
+        try:
+            with open(path, 'a') as profile:
+                profile.write(json.dumps(rows) + '\n')
+        except OSError:
+            # Flushing happens while compiling queries, profiling must never fail one
+            if not self._write_failed:
+                self._write_failed = True
+                logger.warning('Cannot write JSON path usage to %s, counts are dropped', path, exc_info=True)
+
+
+counter = PathUsageCounter()
+
+
+def record(field, keys, lookup_name):
+    counter.record((field.model._meta.label, field.name, tuple(keys), lookup_name))
+
+
+def flush():
+    counter.flush()
+
+
+def load(path):
+    """Sum the counts flushed to a profile file, keyed by (model, field, key path, lookup)."""
+    totals = Counter()
+    with open(path) as profile:
+        for line in profile:
+            line = line.strip()
+            if not line:
+                continue
+            for model, field, keys, lookup, count in json.loads(line):
+                totals[(model, field, tuple(keys), lookup)] += count
+    return totals
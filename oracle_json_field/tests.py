@@ -1,11 +1,19 @@
-from django.db import models
-from django.test import TestCase
+import os
+import tempfile
+from io import StringIO
+
+from django.core.management import call_command
+from django.db import connection, models, transaction
+from django.db.models import signals
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.utils import timezone
 
 # Create your tests here.
 from .constants import JSON_TRUE, JSON_FALSE
 from .managers import JsonQueryManager
-from .fields import JSONField
+from . import profiling
+from .fields import JSONField, JSONTransform
+from .tracking import TrackedDict, TrackedList
 
 
 class JsonModel(models.Model):
@@ -17,6 +25,22 @@ class JsonModel(models.Model):
     objects = JsonQueryManager()
 
 
+class TrackedJsonModel(models.Model):
+    json = JSONField(track_changes=True)
+
+    objects = JsonQueryManager()
+
+
+class TrackedJsonProxyModel(TrackedJsonModel):
+
+    class Meta:
+        proxy = True
+
+
+class TrackedJsonChildModel(TrackedJsonModel):
+    name = models.CharField(max_length=10, default='')
+
+
 class BaseJSONFieldTest(TestCase):
 
     def setUp(self):
@@ -263,4 +287,238 @@ class NestedJSONFieldQueryTestCase(BaseJSONFieldQueryTestCase):
         self.assertDictEqual(lookup.first().json, self.example1)
 
 
+class NonScalarJSONFieldQueryTestCase(BaseJSONFieldTest):
+
+    def setUp(self):
+        super().setUp()
+        self._create_and_fetch({'tags': ['foo', 'bar'], 'l1': {'x_str': 'foo'}})
 
+    def test_icontains_array(self):
+        lookup = JsonModel.objects.filter_json(json__tags__icontains='foo')
+        self.assertEquals(lookup.count(), 1)
+
+    def test_icontains_object(self):
+        lookup = JsonModel.objects.filter_json(json__l1__icontains='foo')
+        self.assertEquals(lookup.count(), 1)
+
+    def test_exact_array(self):
+        # exact compares the scalar JSON_VALUE(), which is NULL for arrays
+        lookup = JsonModel.objects.filter_json(json__tags='foo')
+        self.assertEquals(lookup.count(), 0)
+
+
+class TrackedJSONFieldTest(TransactionTestCase):
+    """Saved changes are only forgotten on commit, which a TestCase transaction never reaches"""
+
+    def setUp(self):
+        TrackedJsonModel.objects.all().delete()
+        self.document = {'l1': {'x_str': 'A Value 1', 'x_list': [1, {'x_int': 2}]}, 'x_pad': 'x' * 200}
+        self.obj = TrackedJsonModel.objects.create(json=self.document)
+        self.db_obj = TrackedJsonModel.objects.get(id=self.obj.id)
+
+    def _operations(self, obj=None):
+        value = TrackedJsonModel._meta.get_field('json').pre_save(obj or self.db_obj, False)
+        return value.operations if isinstance(value, JSONTransform) else None
+
+    def test_from_db_value_is_tracked(self):
+        self.assertIsInstance(self.db_obj.json, TrackedDict)
+        self.assertIsInstance(self.db_obj.json['l1']['x_list'], TrackedList)
+        self.assertDictEqual(self.db_obj.json, self.document)
+
+    def test_untracked_field_is_plain(self):
+        db_obj = JsonModel.objects.get(id=JsonModel.objects.create(json=self.document).id)
+        self.assertIs(type(db_obj.json), dict)
+
+    def test_unchanged_document(self):
+        self.assertEquals(self._operations(), ())
+
+    def test_nested_set_and_remove(self):
+        self.db_obj.json['l1']['x_str'] = 'A Value 2'
+        self.db_obj.json['l1']['x_list'][1]['x_int'] = 3
+        del self.db_obj.json['x_pad']
+        self.assertEquals(self._operations(), (
+            ('REMOVE', ('x_pad',), None),
+            ('SET', ('l1', 'x_str'), '"A Value 2"'),
+            ('SET', ('l1', 'x_list', 1, 'x_int'), '3'),
+        ))
+
+    def test_list_insert_rewrites_list(self):
+        self.db_obj.json['l1']['x_list'].insert(0, 0)
+        self.db_obj.json['l1']['x_list'][2]['x_int'] = 3
+        self.assertEquals(self._operations(), (('SET', ('l1', 'x_list'), '[0, 1, {"x_int": 3}]'),))
+
+    def test_large_change_rewrites_document(self):
+        self.db_obj.json['x_pad'] = 'y' * 200
+        self.assertIsNone(self._operations())
+
+    def test_other_instance_rewrites_document(self):
+        self.obj.json = self.db_obj.json
+        self.obj.json['l1']['x_str'] = 'A Value 2'
+        value = TrackedJsonModel._meta.get_field('json').pre_save(self.obj, False)
+        self.assertNotIsInstance(value, JSONTransform)
+
+    def test_values_list_document_rewrites_document(self):
+        other = TrackedJsonModel.objects.create(json={'x_str': 'Other'})
+        document = TrackedJsonModel.objects.values_list('json', flat=True).get(id=self.obj.id)
+        new_obj = TrackedJsonModel(id=other.id, json=document)
+        self.assertIsNone(self._operations(new_obj))
+        new_obj.save()
+        self.assertDictEqual(TrackedJsonModel.objects.get(id=other.id).json, self.document)
+
+    def test_copied_instance_rewrites_document(self):
+        self.db_obj.pk = None
+        self.db_obj.save()
+        self.assertIsNone(self._operations())
+        self.assertDictEqual(TrackedJsonModel.objects.get(id=self.db_obj.id).json, self.document)
+
+    def test_rolled_back_save_is_retried(self):
+        self.db_obj.json['l1']['x_str'] = 'A Value 2'
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self.db_obj.save()
+                raise RuntimeError
+        self.assertEquals(TrackedJsonModel.objects.get(id=self.obj.id).json['l1']['x_str'], 'A Value 1')
+        self.db_obj.save()
+        self.assertEquals(TrackedJsonModel.objects.get(id=self.obj.id).json['l1']['x_str'], 'A Value 2')
+
+    def test_change_after_save_in_transaction_is_kept(self):
+        with transaction.atomic():
+            self.db_obj.json['l1']['x_str'] = 'A Value 2'
+            self.db_obj.save()
+            self.db_obj.json['l1']['x_str'] = 'A Value 3'
+        self.assertEquals(self._operations(), (('SET', ('l1', 'x_str'), '"A Value 3"'),))
+
+    def test_proxy_and_child_are_tracked(self):
+        child = TrackedJsonChildModel.objects.create(json=self.document, name='child')
+        for db_obj in (TrackedJsonProxyModel.objects.get(id=self.obj.id), TrackedJsonChildModel.objects.get(pk=child.pk)):
+            db_obj.json['l1']['x_str'] = 'A Value 2'
+            self.assertEquals(self._operations(db_obj), (('SET', ('l1', 'x_str'), '"A Value 2"'),))
+            db_obj.save()
+            self.assertEquals(self._operations(db_obj), ())
+            self.assertEquals(type(db_obj).objects.get(pk=db_obj.pk).json['l1']['x_str'], 'A Value 2')
+
+    def test_refresh_from_db_is_patched(self):
+        self.db_obj.refresh_from_db()
+        self.db_obj.json['l1']['x_str'] = 'A Value 2'
+        self.assertEquals(self._operations(), (('SET', ('l1', 'x_str'), '"A Value 2"'),))
+
+    def test_deferred_field_is_patched(self):
+        db_obj = TrackedJsonModel.objects.defer('json').get(id=self.obj.id)
+        db_obj.json['l1']['x_str'] = 'A Value 2'
+        self.assertEquals(self._operations(db_obj), (('SET', ('l1', 'x_str'), '"A Value 2"'),))
+        db_obj.save()
+        self.assertEquals(TrackedJsonModel.objects.get(id=self.obj.id).json['l1']['x_str'], 'A Value 2')
+
+    def test_post_save_only_connected_to_tracked_models(self):
+        self.assertTrue(signals.post_save.has_listeners(TrackedJsonModel))
+        self.assertTrue(signals.post_save.has_listeners(TrackedJsonChildModel))
+        self.assertFalse(signals.post_save.has_listeners(JsonModel))
+
+    def test_save_patch(self):
+        self.db_obj.json['l1']['x_str'] = 'A Value 2'
+        self.db_obj.json['l1']['x_list'].append(5)
+        self.db_obj.json['l1'].pop('x_missing', None)
+        del self.db_obj.json['x_pad']
+        self.db_obj.save()
+        self.assertEquals(self._operations(), ())
+        del self.document['x_pad']
+        self.document['l1']['x_str'] = 'A Value 2'
+        self.document['l1']['x_list'].append(5)
+        self.assertDictEqual(TrackedJsonModel.objects.get(id=self.obj.id).json, self.document)
+
+    def test_save_patch_filter(self):
+        self.db_obj.json['l1']['x_str'] = 'A Value 2'
+        self.db_obj.save()
+        lookup = TrackedJsonModel.objects.filter_json(json__l1__x_str='A Value 2')
+        self.assertEquals(lookup.count(), 1)
+
+
+class JSONPathProfilingTestCase(BaseJSONFieldQueryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        handle, self.profile = tempfile.mkstemp(suffix='.jsonl')
+        os.close(handle)
+        self.addCleanup(os.remove, self.profile)
+
+    def _profile(self):
+        with override_settings(ORACLE_JSON_PATH_PROFILE=self.profile):
+            JsonModel.objects.filter_json(json__x_str='A string 1').count()
+            JsonModel.objects.filter_json(json__x_str='A string 2').count()
+            JsonModel.objects.filter_json(json__x_int__gt=65).count()
+            profiling.flush()
+
+    def test_disabled(self):
+        JsonModel.objects.filter_json(json__x_str='A string 1').count()
+        profiling.flush()
+        self.assertEquals(profiling.load(self.profile), {})
+
+    def test_unwritable_profile(self):
+        profile = os.path.join(self.profile, 'missing', 'profile.jsonl')
+        with override_settings(ORACLE_JSON_PATH_PROFILE=profile, ORACLE_JSON_PATH_PROFILE_INTERVAL=0):
+            lookup = JsonModel.objects.filter_json(json__x_str='A string 1')
+            self.assertEquals(lookup.count(), 1)
+
+    def test_record(self):
+        self._profile()
+        usage = profiling.load(self.profile)
+        self.assertEquals(usage[('oracle_json_field.JsonModel', 'json', ('x_str',), 'exact')], 2)
+        self.assertEquals(usage[('oracle_json_field.JsonModel', 'json', ('x_int',), 'gt')], 1)
+
+    def test_advisor(self):
+        self._profile()
+        out = StringIO()
+        call_command('json_path_advisor', profile=self.profile, sample_percent=100, stdout=out)
+        report = out.getvalue()
+        self.assertIn('oracle_json_field.JsonModel.json $."x_str"', report)
+        self.assertIn('queries: 2 (exact=2)', report)
+        self.assertIn('10 with a value, 10 distinct values', report)
+        self.assertIn('CREATE INDEX', report)
+        self.assertIn('RETURNING NUMBER', report)
+
+
+class JSONPathAdvisorIndexTestCase(TransactionTestCase):
+    """The suggested indexes must match the SQL the key lookups compile to"""
+
+    def setUp(self):
+        JsonModel.objects.bulk_create([JsonModel(json={'x_str': 'A string %d' % i, 'x_int': i}) for i in range(2000)])
+        handle, self.profile = tempfile.mkstemp(suffix='.jsonl')
+        os.close(handle)
+        self.addCleanup(os.remove, self.profile)
+        with connection.cursor() as cursor:
+            cursor.execute('BEGIN DBMS_STATS.GATHER_TABLE_STATS(USER, %s); END;', [JsonModel._meta.db_table.upper()])
+
+    def _create_indexes(self):
+        with override_settings(ORACLE_JSON_PATH_PROFILE=self.profile):
+            JsonModel.objects.filter_json(json__x_str='A string 1').count()
+            JsonModel.objects.filter_json(json__x_int__gt=1990).count()
+            profiling.flush()
+        out = StringIO()
+        call_command('json_path_advisor', profile=self.profile, stdout=out)
+        statements = [line.strip().rstrip(';') for line in out.getvalue().splitlines()
+                      if line.strip().startswith('CREATE INDEX')]
+        self.assertEquals(len(statements), 2)
+        indexes = {}
+        with connection.cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
+                index = statement.split()[2]
+                self.addCleanup(self._execute, 'DROP INDEX %s' % index)
+                indexes['number' if 'RETURNING NUMBER' in statement else 'text'] = index.strip('"')
+        return indexes
+
+    def _execute(self, sql, params=()):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    def _explain(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN PLAN FOR ' + sql, params)
+            cursor.execute('SELECT plan_table_output FROM TABLE(DBMS_XPLAN.DISPLAY())')
+            return '\n'.join(row[0] for row in cursor.fetchall())
+
+    def test_indexes_are_used(self):
+        indexes = self._create_indexes()
+        self.assertIn(indexes['text'], self._explain(JsonModel.objects.filter_json(json__x_str='A string 1')))
+        self.assertIn(indexes['number'], self._explain(JsonModel.objects.filter_json(json__x_int__gt=1990)))
@@ -0,0 +1,343 @@
+import copy
+import json
+import weakref
+
+from .constants import JSON_PATCH_REMOVE, JSON_PATCH_SET
+
+__all__ = ['TrackedDict', 'TrackedList', 'track', 'untrack']
+
+
+class TrackedContainer:
+    """
+    Mixin for the dict/list subclasses returned by a JSONField(track_changes=True).
+
+    Every container knows its parent and the key it is stored under, so a mutation
+    can record its path on the root document without copying anything. The root
+    holds the dirty paths in ``_changes`` (path tuple -> (JSON_PATCH_SET/REMOVE, serial)),
+    the serial tells a path changed again after a save from one that did not.
+
+    Dicts and lists assigned into a tracked document are copied into tracked
+    containers, so later changes made through the original object are not seen.
+    """
+
+    def _init_tracking(self, parent, key):
+        self._parent = parent
+        self._key = key
+        self._changes = None
+        self._serial = 0
+        self._size = None
+        self._owner = None
+        self._owner_pk = None
+        self._saving = None
+
+    def _wrap(self, key, value):
+        if isinstance(value, TrackedContainer) and value._parent is self and value._key == key:
+            return value
+        return track(value, parent=self, key=key)
+
+    def _path(self):
+        path = []
+        node = self
+        while node._parent is not None:
+            path.append(node._key)
+            node = node._parent
+        if node._changes is None:
+            # Detached from the document, nothing to record against
+            return None, None
+        path.reverse()
+        return node, tuple(path)
+
+    def _mark(self, key, operation):
+        root, path = self._path()
+        if root is None:
+            return
+        if key is not None:
+            path += (key,)
+        root._serial += 1
+        root._changes[path] = (operation, root._serial)
+
+    def _mark_self(self):
+        self._mark(None, JSON_PATCH_SET)
+
+    def __reduce_ex__(self, protocol):
+        # Pickle as plain JSON data, a root keeps its pending changes but not its owner
+        if self._changes is None:
+            return untrack, (untrack(self),)
+        return _rebuild_root, (untrack(self), dict(self._changes), self._size)
+
+    def __copy__(self):
+        # Copies are plain, untracked containers
+        return self._plain_type(self)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(untrack(self), memo)
+
+
+def _detach(value):
+    if isinstance(value, TrackedContainer):
+        value._parent = None
+
+
+class TrackedDict(TrackedContainer, dict):
+    _plain_type = dict
+
+    def __init__(self, *args, **kwargs):
+        self._init_tracking(None, None)
+        super().__init__(*args, **kwargs)
+
+    def __setitem__(self, key, value):
+        old = self.get(key)
+        if old is not value:
+            _detach(old)
+        super().__setitem__(key, self._wrap(key, value))
+        self._mark(key, JSON_PATCH_SET)
+
+    def __delitem__(self, key):
+        _detach(self.get(key))
+        super().__delitem__(key)
+        self._mark(key, JSON_PATCH_REMOVE)
+
+    def pop(self, key, *args):
+        had_key = key in self
+        value = super().pop(key, *args)
+        if had_key:
+            _detach(value)
+            self._mark(key, JSON_PATCH_REMOVE)
+        return value
+
+    def popitem(self):
+        key, value = super().popitem()
+        _detach(value)
+        self._mark(key, JSON_PATCH_REMOVE)
+        return key, value
+
+    def clear(self):
+        for value in self.values():
+            _detach(value)
+        super().clear()
+        self._mark_self()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+
+class TrackedList(TrackedContainer, list):
+    _plain_type = list
+
+    def __init__(self, *args):
+        self._init_tracking(None, None)
+        super().__init__(*args)
+
+    def _reindex(self):
+        # Structural changes shift indices, so the whole list is rewritten
+        for index, value in enumerate(self):
+            if isinstance(value, TrackedContainer):
+                value._key = index
+        self._mark_self()
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            for old in self[index]:
+                _detach(old)
+            super().__setitem__(index, [self._wrap(None, item) for item in value])
+            self._reindex()
+            return
+        if index < 0:
+            index += len(self)
+        if self[index] is not value:
+            _detach(self[index])
+        super().__setitem__(index, self._wrap(index, value))
+        self._mark(index, JSON_PATCH_SET)
+
+    def __delitem__(self, index):
+        old = self[index]
+        for item in (old if isinstance(index, slice) else [old]):
+            _detach(item)
+        super().__delitem__(index)
+        self._reindex()
+
+    def append(self, value):
+        super().append(self._wrap(len(self), value))
+        self._reindex()
+
+    def extend(self, values):
+        super().extend([self._wrap(None, value) for value in values])
+        self._reindex()
+
+    def insert(self, index, value):
+        super().insert(index, self._wrap(None, value))
+        self._reindex()
+
+    def pop(self, *args):
+        value = super().pop(*args)
+        _detach(value)
+        self._reindex()
+        return value
+
+    def remove(self, value):
+        index = self.index(value)
+        del self[index]
+
+    def clear(self):
+        for value in self:
+            _detach(value)
+        super().clear()
+        self._mark_self()
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self._reindex()
+
+    def reverse(self):
+        super().reverse()
+        self._reindex()
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def __imul__(self, count):
+        self[:] = list(self) * count
+        return self
+
+
+def track(value, parent=None, key=None):
+    """
+    Recursively convert decoded JSON into tracked containers.
+
+    Called without a parent the result is a root document that records changes.
+    """
+    if isinstance(value, dict):
+        tracked = TrackedDict()
+        dict.update(tracked, ((k, track(v, tracked, k)) for k, v in value.items()))
+    elif isinstance(value, list):
+        tracked = TrackedList()
+        list.extend(tracked, (track(v, tracked, i) for i, v in enumerate(value)))
+    else:
+        return value
+    tracked._parent = parent
+    tracked._key = key
+    if parent is None:
+        tracked._changes = {}
+    return tracked
+
+
+def untrack(value):
+    """Return a plain dict/list copy of a (possibly) tracked value."""
+    if isinstance(value, dict):
+        return {k: untrack(v) for k, v in value.items()}
+    elif isinstance(value, list):
+        return [untrack(v) for v in value]
+    return value
+
+
+def _rebuild_root(value, changes, size):
+    root = track(value)
+    root._changes.update(changes)
+    root._serial = max([serial for _, serial in changes.values()] or [0])
+    root._size = size
+    return root
+
+
+def is_tracked_root(value):
+    return isinstance(value, TrackedContainer) and value._changes is not None
+
+
+def mark_loaded(root, size):
+    root._size = size
+
+
+def claim(root, owner):
+    """Bind a root document to the model instance, and row, it was loaded from."""
+    if root._owner is None:
+        root._owner = weakref.ref(owner)
+        root._owner_pk = owner.pk
+
+
+def reclaim(root, owner):
+    """Take over a document another instance loaded for owner's row, as refresh_from_db() does."""
+    if root._owner is not None and root._owner_pk == owner.pk:
+        root._owner = weakref.ref(owner)
+
+
+def is_owned_by(root, owner):
+    return root._owner is not None and root._owner() is owner and root._owner_pk == owner.pk
+
+
+def start_save(root):
+    """Snapshot the changes about to be written, see mark_clean()."""
+    root._saving = dict(root._changes)
+
+
+def finish_save(root):
+    saved, root._saving = root._saving, None
+    return saved
+
+
+def mark_clean(root, saved):
+    """Forget the saved changes, unless a path was changed again since it was saved."""
+    for path, change in saved.items():
+        if root._changes.get(path) == change:
+            del root._changes[path]
+
+
+_MISSING = object()
+
+
+def _resolve(node, path):
+    for key in path:
+        # Dict keys must be strings and list keys indices to map onto a JSON path
+        if isinstance(node, dict) and isinstance(key, str) and key in node:
+            node = node[key]
+        elif isinstance(node, list) and isinstance(key, int) and 0 <= key < len(node):
+            node = node[key]
+        else:
+            return _MISSING
+    return node
+
+
+def get_patch_operations(root, encoder, max_ratio):
+    """
+    Reduce the dirty paths of a root document to a list of patch operations.
+
+    Returns a list of (operation, path, serialized_value) tuples, or None when the
+    document should be rewritten in full: the root itself changed, the loaded size
+    is unknown, or the serialized changes exceed ``max_ratio`` of the document.
+    """
+    if root._size is None or () in root._changes:
+        return None
+
+    operations = []
+    changed_size = 0
+    dirty = root._changes
+    for path in sorted(dirty, key=len):
+        if any(path[:depth] in dirty for depth in range(1, len(path))):
+            # An ancestor is already rewritten or removed
+            continue
+        operation, _ = dirty[path]
+        node = _resolve(root, path[:-1])
+        if not isinstance(node, (dict, list)):
+            return None
+        value = None
+        if operation == JSON_PATCH_SET:
+            node = _resolve(node, path[-1:])
+            if node is _MISSING:
+                return None
+            value = json.dumps(node, cls=encoder)
+            changed_size += len(value)
+        elif not isinstance(node, dict) or not isinstance(path[-1], str):
+            return None
+        if changed_size > root._size * max_ratio:
+            return None
+        operations.append((operation, path, value))
+    return operations
@@ -1,5 +1,5 @@
 from distutils.core import Command
-from setuptools import setup
+from setuptools import find_packages, setup
 
 
 class TestCommand(Command):
@@ -45,7 +45,7 @@ class TestCommand(Command):
 setup(
     name='oracle-json-field',
     version=__import__('oracle_json_field').__version__,
-    packages=['oracle_json_field'],
+    packages=find_packages(),
     license='MIT',
     include_package_data=True,
     author='Vackar Afzal',